@@ -12,6 +12,7 @@ __version__ = '0.5.00' # of the parser, not OBF
 
 import yaml
 import copy
+import collections
 import re
 import time # just for code profiling
 
@@ -66,6 +67,120 @@ _two_dots_re = re.compile(r".*\..*\.")  # match if two '.' anywhere
 _looks_like_special_key_re = re.compile(r"^=.+=$")  # match if string has '=' first and last
 _label_dot_units_re = re.compile(r"^([a-zA-Z_][^.]*)\.(.+)$") # match X.Y captures X and Y
 _numeric_re = re.compile(r"^\d+$") # match if a string is exclusively numeric, so int() will suceed
+_digits_as_str_re = re.compile(r"^_\d+_$") # match '_123_', digits to keep as a str
+
+# Diagnostics, code: (severity, message); see OBF_Report. Messages are only
+# formatted (with key, detail, source) when the report is read.
+_ERROR = 'ERROR'
+_WARNING = 'WARNING'
+_NOTE = 'NOTE'
+_MESSAGES = {
+    'colon_space': (_WARNING, "OBF: WARNING: adding space after colon for key '%(key)s'"),
+    'preprocess_unknown': (_WARNING, "OBF: 'preprocess: %(detail)s' not understood, so ignored"),
+    'not_implemented': (_WARNING, "OBF: '%(detail)s' not implemented yet"),
+    'special_key_ignored': (_NOTE, "OBF: ignoring key '%(key)s'"),
+    'bad_key': (_WARNING, "OBF: ignoring bad key '%(key)s'"),
+    'units_conflict': (_ERROR, "OBF: ERROR: '%(key)s' has units '%(detail)s', but conflicts with an existing key"),
+    'index_zero': (_WARNING, "OBF: WARNING: '" + _ONE_INDEXED + "' requested, but index 0 received"),
+    'repeated_key': (_WARNING, "OBF: WARNING: key '%(key)s' repeated in '%(source)s' "),
+    'bad_units': (_WARNING, "OBF: WARN: bad units for '%(key)s."),
+    'random_seed_none': (_WARNING, "OBF: WARNING: ambiguous random_seed 'None'"),
+    'mouse_xy': (_ERROR, "OBF: ERROR: mouse lacks (x,y) or pos[]"),
+    'text': (None, "%(key)s"), # free text, from OBF_Report.append(); severity from the text
+    'capped': (_NOTE, "OBF: NOTE: %(detail)s more '%(key)s' messages not recorded"),
+    }
+_REPORT_CAP = 100 # distinct messages kept per code
+
+
+class OBF_Report(object):
+    """Class for collecting parser diagnostics as compact, structured entries.
+    
+    Each entry is [code, key, line, detail, count]; see _MESSAGES for the codes.
+    Entries are deduplicated as they are added: a message that does not name
+    its key (e.g., 'index_zero') is one entry no matter how many keys trigger
+    it, keeping the first key and line. At most `cap` distinct entries are
+    kept per code; any more are only counted.
+    
+    A convention calling add() without a line gets the line of the top-level
+    key it is working within (self.line, set by OBF_Load.process_values()).
+    
+    Reading the report formats the messages, in the order first added:
+    iterating, 'in', len(), and str() all work on the message strings, so a
+    report can be used much like the list of strings it replaces. append(text)
+    adds free text, e.g., from a custom convention.
+    """
+    def __init__(self, source='', cap=_REPORT_CAP):
+        self.source = source
+        self.cap = cap
+        self._entries = [] # in order added
+        self._index = {} # (code, key, detail) --> entry
+        self._distinct = {} # code --> number of distinct entries
+        self._dropped = {} # code --> occurrences beyond the cap
+        self.line = None # line of the block being processed, if known
+    
+    def add(self, code, key=None, line=None, detail=None):
+        """Record one occurrence of diagnostic code; line is in the source, 1-based."""
+        severity, message = _MESSAGES[code]
+        if line is None:
+            line = self.line
+        if not '%(key)s' in message:
+            key_id = None
+        else:
+            key_id = key
+        if not '%(detail)s' in message:
+            detail = None
+        entry = self._index.get((code, key_id, detail))
+        if entry is not None:
+            entry[4] += 1
+        elif self._distinct.get(code, 0) >= self.cap:
+            self._dropped[code] = self._dropped.get(code, 0) + 1
+        else:
+            entry = [code, key, line, detail, 1]
+            self._index[(code, key_id, detail)] = entry
+            self._entries.append(entry)
+            self._distinct[code] = self._distinct.get(code, 0) + 1
+    def append(self, text):
+        """Record a free-text message."""
+        self.add('text', text)
+    
+    def entries(self):
+        """Returns [(code, severity, key, line, count), ...] in the order first added."""
+        return [(code, _MESSAGES[code][0] or _text_severity(key), key, line, count)
+                for code, key, line, detail, count in self._entries]
+    def count(self, code):
+        """Returns the number of occurrences of code, including any beyond the cap."""
+        return (sum([entry[4] for entry in self._entries if entry[0] == code]) +
+                self._dropped.get(code, 0))
+    def messages(self, verbose=False):
+        """Returns the formatted messages; verbose adds the line number and count."""
+        messages = []
+        for code, key, line, detail, count in self._entries:
+            message = _MESSAGES[code][1] % {'key': key, 'detail': detail, 'source': self.source}
+            if verbose:
+                message += ' [line %s, x%d]' % (line, count)
+            messages.append(message)
+        for code in sorted(self._dropped):
+            messages.append(_MESSAGES['capped'][1] % {'key': code, 'detail': self._dropped[code]})
+        return messages
+    
+    def __iter__(self):
+        return iter(self.messages())
+    def __contains__(self, message):
+        return message in self.messages()
+    def __len__(self):
+        return len(self._entries) + len(self._dropped)
+    def __str__(self):
+        return str(self.messages())
+    def __repr__(self):
+        return str(self)
+
+def _text_severity(text):
+    # severity of a free-text message, from how the parser words its own
+    if 'ERROR' in text:
+        return _ERROR
+    if 'WARN' in text:
+        return _WARNING
+    return _NOTE
 
 
 class OBF_Load(dict):
@@ -75,7 +190,7 @@ class OBF_Load(dict):
     plus extra parsing specific to behavioral-data. Result:
     - self.data   <-- data structure
     - self.source <-- repr of data source
-    - self.report <-- warning & error messages
+    - self.report <-- warning & error messages, an OBF_Report
     - self.time   <-- code timing profile
     - self.prepro <-- preprocessing requested
     - self.yaml   <-- yaml parser details
@@ -101,8 +216,14 @@ class OBF_Load(dict):
     # I had build issues, no yaml.h, did not pursue; maybe this: http://pyyaml.org/ticket/70
     # interesting: yaml.load(input, Loader=yaml.CLoader)
 
-    def __init__(self, source, conventions={}, timing=False, units=_UNITS):
+    def __init__(self, source, conventions={}, timing=False, units=_UNITS, lazy=False,
+                 report_cap=_REPORT_CAP):
         """
+        lazy=True defers applying conventions to each top-level subtree of
+        self.data until that subtree is first accessed; self.data is then not a
+        dict (see process_values()), use dict(self.data) where one is needed.
+        report_cap limits the
+        distinct messages kept per diagnostic code (see OBF_Report).
         """
         # initialize timing profile (generate one even if not requested)
         self.time = []
@@ -112,7 +233,7 @@ class OBF_Load(dict):
         dict.__init__(self) # at first a dict made sense, but things have evolved
         self.source = str(source)  # save the name / repr of the source
         self.units = map(lambda x: x.lower(), units) # case-insensitive
-        self.report = [] # container for warnings and other notes
+        self.report = OBF_Report(self.source, report_cap) # warnings and other notes
         
         # details of the YAML parser used for this OBF parsing:
         self.yaml = {}
@@ -149,12 +270,11 @@ class OBF_Load(dict):
         
         # set conventions (hot_key: action pairings), then parse
         merged_conv = dict(_get_default_conventions(), **conventions) 
-        self.process_values(merged_conv)
+        self.process_values(merged_conv, lazy)
         
         # self.adjust_indices()  # if ONE_INDEXED alert about non-null [0] values?
         
-        # reporting and strictness level:
-        self.report = list(set(self.report))  # remove redundant
+        # strictness level:
         if _STRICT in self.prepro:
             pass # if 'ERROR' in any message, nullify self.data
         if _NOT_STRICT in self.prepro:
@@ -180,6 +300,8 @@ class OBF_Load(dict):
         # filter once:
         key_lines = [(i, line) for i, line in enumerate(raw_text) if not line[0] in [' ', '#', '-', '.']]
         special_lines = [line for i, line in key_lines if line.startswith('=')]
+        # source line number of each top-level key, for self.report:
+        self.key_lines = dict((line[:line.find(':')], i + 1) for i, line in key_lines if line.startswith('='))
         
         header = [line for line in special_lines if line.startswith(_HEADER)]
         if len(header) != 1:
@@ -198,7 +320,7 @@ class OBF_Load(dict):
         colon_nonwhitespace = [i for i, line in key_lines if _almost_good_key_re.match(line)]
         for i in colon_nonwhitespace:
             key = raw_text[i][:raw_text[i].find(':')]
-            self.report.append("OBF: WARNING: adding space after colon for key '%s'" % key)
+            self.report.add('colon_space', key, i + 1)
             raw_text[i] = raw_text[i].replace(':', ': ')
         
     def process_yaml(self, raw_text):
@@ -227,6 +349,7 @@ class OBF_Load(dict):
         data0 = yaml.safe_load(text)
         self.time.append(('end yaml-load (with_libyaml = %s)' %
                             str(self.yaml['__with_libyaml__']), time.time()))
+        self.key_lines.update((raw_text[i][:raw_text[i].find(':')], i + 1) for i, line in key_lines)
         
         prepro = []
         if 'preprocess' in data0[_HEADER].keys():
@@ -236,14 +359,14 @@ class OBF_Load(dict):
             if type(prepro) == str:
                 prepro = prepro.split(',')
             elif type(prepro) != list:
-                self.report.append("OBF: 'preprocess: %s' not understood, so ignored" % str(prepro))
+                self.report.add('preprocess_unknown', detail=str(prepro))
             prepro = map(lambda s: s.lower().strip().lstrip(), prepro)
             # check for unknown pre-proc
             if set(prepro).difference(_PREPROC):
-                self.report.append("OBF: 'preprocess: %s' not understood, so ignored" %
-                                   ', '.join(list(set(prepro).difference(_PREPROC))) )
+                self.report.add('preprocess_unknown',
+                                detail=', '.join(list(set(prepro).difference(_PREPROC))))
             if _WARN in prepro:
-                self.report.append("OBF: '%s' not implemented yet" % _WARN)
+                self.report.add('not_implemented', detail=_WARN)
         
         # do pre-processing; must yaml.load() again if do auto_index:
         if len(prepro) > 0:
@@ -261,6 +384,7 @@ class OBF_Load(dict):
                         # append increasing integers if more than one line
                         for k, linenum in enumerate(matching_lines):
                             raw_text[linenum] = raw_text[linenum].replace(key, key + '.' + str(k + self.base_index))
+                            self.key_lines[key + '.' + str(k + self.base_index)] = linenum + 1
                 # reload everything, now that lines have been disambiguated
                 text = '\n'.join(raw_text)
                 self.time.append(('start yaml-load #2 auto_index',time.time()))
@@ -272,11 +396,15 @@ class OBF_Load(dict):
                     if key != key.lower():
                         data0[key.lower()] = data0[key]
                         del data0[key]
+                        if key in self.key_lines:
+                            self.key_lines[key.lower()] = self.key_lines.pop(key)
             elif _KEYS_UPPER in prepro:
                 for key in obf_keys:
                     if key != key.upper():
                         data0[key.upper()] = data0[key]
                         del data0[key]
+                        if key in self.key_lines:
+                            self.key_lines[key.upper()] = self.key_lines.pop(key)
         
         self.time.append(('end preprocess', time.time()))
         return data0, prepro
@@ -290,14 +418,14 @@ class OBF_Load(dict):
         nonspecial_keys = set(self.data.keys()).difference(set(_SPECIAL))
         ignore_keys = [k for k in nonspecial_keys if _looks_like_special_key_re.match(k)]
         for key in ignore_keys:
-            self.report.append("OBF: ignoring key '%s'" % key)
+            self.report.add('special_key_ignored', key, self.key_lines.get(key))
             del self.data[key]
         
         # remove keys with illegal OBF characters:
         obf_keys = set(self.data.keys()).difference(set(_SPECIAL))
         bad_keys = [k for k in obf_keys if _bad_key_re.search(k)]
         for key in bad_keys:
-            self.report.append("OBF: ignoring bad key '%s'" % key)
+            self.report.add('bad_key', key, self.key_lines.get(key))
             del self.data[key]
         
         obf_keys = set(self.data.keys()).difference(set(_SPECIAL))
@@ -306,6 +434,7 @@ class OBF_Load(dict):
         
         # expand complex keys:
         self.head_name_cache = {} # cache for add_one_value()
+        self.value_lines = {} # id(value) --> source line, for process_values()
         for key in other_keys:
             name, index = key.split('.',1)
             # handle case where its simple.units, not a complex keys:
@@ -315,11 +444,13 @@ class OBF_Load(dict):
             # some obf_keys with a '.' might be key.units, rather than trial.index:
             if index_lower in self.units:
                 if hasattr(self.data, name): 
-                    self.report.append("OBF: ERROR: '%s' has units '%s', but conflicts with an existing key" % (key, index_lower))
+                    self.report.add('units_conflict', key, self.key_lines.get(key), index_lower)
                 else:
                     self.data[name] = self.data[key]
                     self.data[name+'.'+_UNITS_LABEL] = index
                     del self.data[key]
+                    if key in self.key_lines:
+                        self.key_lines[name] = self.key_lines[key]
                 continue
             # parse each sub-item of the complex key: 
             name_indices = []
@@ -332,6 +463,9 @@ class OBF_Load(dict):
             self.add_one_value(name_indices, key) # the value to add is self.data[key]
         
         del self.head_name_cache
+        for key, value in self.data.iteritems():
+            if type(value) in (list, dict) and key in self.key_lines:
+                self.value_lines[id(value)] = self.key_lines[key]
         self.time.append(('end parse keys;  time %.3f' % (time.time() - t0), time.time()))
     
     def add_one_value(self, name_indices, key):
@@ -375,7 +509,7 @@ class OBF_Load(dict):
         
         for name, index, index_is_int in name_indices:
             if index == 0 and self.base_index == 1:
-                self.report.append("OBF: WARNING: '%s' requested, but index 0 received" % _ONE_INDEXED)
+                self.report.add('index_zero', key, self.key_lines.get(key))
             head_shadow_str += "['"+name+"']"
             if head_shadow_str in self.head_name_cache: # then head[name] exists
                 # assigning to head => assigning to self.data[][]...[][]:
@@ -387,7 +521,7 @@ class OBF_Load(dict):
                     if head[name][index] is None:
                         head[name][index] = {} # next name goes in here
                     else:
-                        self.report.append("OBF: WARNING: key '%s' repeated in '%s' " % (key, self.source))
+                        self.report.add('repeated_key', key, self.key_lines.get(key))
                 elif not index_is_int and type(head[name]) == dict:
                     # ensure that index is a key of name; init it if its a new key
                     if not index in head[name].keys():
@@ -407,19 +541,34 @@ class OBF_Load(dict):
             head_shadow_str += '['+repr(index)+']'
         
         # assign the value to the end; must be last_head[][]=..., head= ... fails
-        last_head[name][index] = self.data[key]
+        value = last_head[name][index] = self.data[key]
+        if type(value) in (list, dict) and key in self.key_lines:
+            self.value_lines[id(value)] = self.key_lines[key]
         
         del self.data[key]
         
-    def process_values(self, conventions):
-        """Inspect and process every value, descending recursively.
+    def process_values(self, conventions, lazy=False):
+        """Inspect and process every value, descending iteratively.
         
-        Keys can trigger further processing, based on conventions.
+        Keys can trigger further processing, based on conventions. If lazy is
+        True, conventions are applied to the top-level keys now, and to each
+        top-level subtree the first time it is accessed. self.data is then a
+        _LazyData, a Mapping but not a dict: isinstance(..., dict), has_key(),
+        and json.dumps() do not work on it; dict(self.data) does.
         """
         t0 = time.time()
-        hot_keys = conventions.keys() # unordered
-        def walk_values(this_level):
-            """trigger actions based on hot_keys; "walk" means descend recursively.
+        # split hot_keys once: every hot_key is tried as a literal (dict lookup),
+        # those with ^...$ are also tried as a precompiled regex
+        literal_keys = dict(conventions)
+        regex_keys = [(re.compile(regex), conventions[regex]) for regex in conventions
+                      if regex[0] == '^' and regex[-1] == '$']
+        # source lines, for messages from actions; kept by walk_values() if lazy:
+        key_lines = self.key_lines
+        value_lines = self.value_lines
+        report = self.report
+        
+        def apply_conventions(this_level, line, top=False):
+            """trigger actions based on hot_keys, for the keys of one dict only.
             
             Conventions consist of hot_key: action pairs, and are not formally part
             of the OBF definition. Custom conventions can be defined and
@@ -435,28 +584,483 @@ class OBF_Load(dict):
             powerful to allow multiple matches; that would require also being able 
             to specify the order in which matches should be attempted.
             """
-            if type(this_level) == list:
-                for item in this_level: # or this_level[self.base-index:]?
-                    if type(item) in [list, dict]:
-                        walk_values(item)
-            elif type(this_level) == dict:        
-                for key in this_level.keys():
-                    status = None
-                    for regex in hot_keys:
-                        if regex == key or (regex[0] == '^' and regex[-1] == '$' and re.match(regex, key)):
-                            status = conventions[regex](this_level, key, self)
+            triggered = None # only allocated if some key is hot, which is rare
+            for key in this_level:
+                action = literal_keys.get(key)
+                if action is None and isinstance(key, basestring):
+                    for regex, regex_action in regex_keys:
+                        if regex.match(key):
+                            action = regex_action
                             break
-                    if status:
-                        for k in status.keys():
-                            # if k == some-code: do something
-                            if k == 'new_key': key = status['new_key']
-                    if type(this_level[key]) in [list, dict]:
-                        walk_values(this_level[key])
-            else:
-                assert False, "OBF: BUG in walk_values(): received a '%s'" % type(this_level)
-        walk_values(self.data)
+                if action is not None:
+                    if triggered is None:
+                        triggered = []
+                    triggered.append((key, action))
+            # actions can add, rename, or delete keys, so not while iterating;
+            # values are descended afterwards, so a 'new_key' is walked anyway
+            if triggered:
+                for key, action in triggered:
+                    if key in this_level:
+                        report.line = key_lines.get(key) if top else line
+                        action(this_level, key, self)
+                report.line = None
+        
+        def walk_values(this_level):
+            """apply conventions to every dict within this_level; "walk" means descend.
+            
+            Uses an explicit stack rather than recursion, so that deeply nested
+            keys (e.g., list_of_lists.0+b.0+...+z.0) do not approach the
+            recursion limit. A parallel stack carries the source line of the
+            enclosing top-level key, where known.
+            """
+            assert type(this_level) in (list, dict), "OBF: BUG in walk_values(): received a '%s'" % type(this_level)
+            stack = [this_level]
+            lines = [value_lines.get(id(this_level))]
+            pop = stack.pop
+            push = stack.append
+            pop_line = lines.pop
+            push_line = lines.append
+            while stack:
+                this_level = pop()
+                line = pop_line()
+                if type(this_level) is dict:
+                    apply_conventions(this_level, line)
+                    items = this_level.itervalues()
+                else:
+                    items = this_level # or this_level[self.base-index:]?
+                for item in items:
+                    item_type = type(item)
+                    if item_type is dict or item_type is list:
+                        push(item)
+                        push_line(value_lines.get(id(item), line))
+        
+        apply_conventions(self.data, None, top=True)
+        if lazy:
+            self.data = _LazyData(self.data, walk_values)
+        else:
+            for value in self.data.values():
+                if type(value) in (list, dict):
+                    walk_values(value)
+        del self.key_lines
+        del self.value_lines
         self.time.append(('end proc values; time %.3f' % (time.time() - t0), time.time()))
 
+
+class _LazyData(collections.MutableMapping):
+    """Mapping whose top-level subtrees get conventions applied on first access.
+    
+    Used as OBF_Load.data when lazy=True. The top-level keys have already been
+    processed; the value of each key is walked the first time it is retrieved.
+    Most uses touch only a few top-level keys (e.g., 'trial'), so the rest are
+    never walked. resolve() walks everything still pending.
+    
+    Not a dict subclass: C code that reads a dict directly (dict(d), {}.update(d),
+    json.dumps, ...) would bypass the walk and see unprocessed subtrees. Every
+    value read here goes through __getitem__, so dict(lazy.data) and copy() are
+    fully processed, and json.dumps(lazy.data) fails rather than being wrong.
+    
+    Notes:
+    - messages from lazily-applied conventions are added to .report when the
+      subtree is accessed, i.e., after OBF_Load() has returned
+    """
+    def __init__(self, data, walk):
+        self._data = data
+        self._walk = walk
+        self._pending = set(k for k, v in data.iteritems() if type(v) in (list, dict))
+    
+    def _walk_key(self, key):
+        # no longer pending while walked, in case a convention reads it again
+        self._pending.discard(key)
+        try:
+            self._walk(self._data[key])
+        except:
+            self._pending.add(key) # walk it all again next time, not half-done
+            raise
+    def resolve(self):
+        """Apply conventions to all pending subtrees."""
+        while self._pending:
+            self._walk_key(iter(self._pending).next())
+    
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._walk_key(key)
+        return self._data[key]
+    def __setitem__(self, key, value):
+        self._pending.discard(key)
+        self._data[key] = value
+    def __delitem__(self, key):
+        self._pending.discard(key)
+        del self._data[key]
+    def __contains__(self, key):
+        return key in self._data
+    def __iter__(self):
+        return iter(self._data)
+    def __len__(self):
+        return len(self._data)
+    
+    def copy(self):
+        """Returns a plain, fully processed dict (shares the subtrees)."""
+        self.resolve()
+        return self._data.copy()
+    def __repr__(self):
+        self.resolve()
+        return repr(self._data)
+    def __reduce__(self):
+        # pickle / deepcopy as a plain, fully processed dict
+        return (dict, (self.copy(),))
+
+
+class OBF_Feed(object):
+    """Class for collecting OBF text as it arrives, e.g., in chunks from a socket.
+    
+    feed() only stores the chunk, so it is cheap enough to call from an event
+    loop; nothing is parsed until the feed is given to OBF_Load() (directly, or
+    via OBF_LoadPool.load()), for which it is a data source having .readlines().
+    """
+    def __init__(self, name='<OBF_Feed>'):
+        self.name = name
+        self._chunks = []
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+    def readlines(self):
+        return ''.join(self._chunks).splitlines(True)
+    def __str__(self):
+        return self.name
+
+
+class OBF_LoadPool(object):
+    """Class for running OBF_Load() in the background, at most max_loads at once.
+    
+    load() returns immediately with a result object (.ready(), .wait(),
+    .successful(), .get()); the parse itself (yaml, keys, values) runs in a
+    worker thread. get() returns the same OBF_Load object as a direct call would
+    give, or raises its exception. Any other keyword arguments are passed on to
+    OBF_Load() for every load.
+    
+    Notes:
+    - exactly one callback is called per load, also when the load fails:
+      error_callback(exception) if given, else callback(exception)
+    - callbacks are called from a pool thread, not the caller's thread; from
+      an event loop, hand the result back with the loop's thread-safe call
+      (e.g., reactor.callFromThread, IOLoop.add_callback)
+    - pass pool=multiprocessing.Pool(n) to parse in processes instead of
+      threads; sources must then be picklable (an OBF_Feed is, a file is not),
+      and the result is pickled back (lazy=True is resolved first)
+    """
+    def __init__(self, max_loads=4, pool=None, **load_kwargs):
+        if pool is None:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(max_loads)
+        self.pool = pool
+        self.load_kwargs = load_kwargs
+    def load(self, source, callback=None, error_callback=None):
+        """Queue source (an OBF_Feed, or anything with .readlines()) for OBF_Load()."""
+        done = None
+        if callback is not None or error_callback is not None:
+            def done(outcome):
+                loaded, value = outcome
+                if loaded or error_callback is None:
+                    if callback is not None:
+                        callback(value)
+                else:
+                    error_callback(value)
+        return _LoadResult(self.pool.apply_async(_load_outcome, (source, self.load_kwargs), {}, done))
+    def close(self):
+        """No more loads; wait for those already queued."""
+        self.pool.close()
+        self.pool.join()
+
+
+def _load_outcome(source, load_kwargs):
+    # for OBF_LoadPool: a failed load is returned rather than raised, because
+    # the pool only calls its callback on success
+    try:
+        return True, OBF_Load(source, **load_kwargs)
+    except Exception, e:
+        return False, e
+
+class _LoadResult(object):
+    """What OBF_LoadPool.load() returns: an AsyncResult of _load_outcome(), unpacked."""
+    def __init__(self, result):
+        self._result = result
+    def ready(self):
+        return self._result.ready()
+    def wait(self, timeout=None):
+        self._result.wait(timeout)
+    def successful(self):
+        return self._result.successful() and self._result.get()[0]
+    def get(self, timeout=None):
+        loaded, value = self._result.get(timeout)
+        if not loaded:
+            raise value
+        return value
+
+
+def iter_rows(source, units=_UNITS):
+    """Yields one flat dict ("row") per complex-key block of an OBF source.
+    
+    source is raw OBF text (anything with .readlines(), or a file); or a
+    mapping of top-level key: value, as from yaml.safe_load(). The nested
+    structure that OBF_Load() builds is never made. Raw text is read in one pass
+    and split into top-level blocks, which are parsed _ROWS_BATCH at a time
+    (using libyaml if available). As in OBF_Load(), a repeated key keeps only
+    its last block.
+    
+    For 'trial.2 + text.red + color.blue: {response: blue, rt.ms: 765}' the row is
+    {'trial': 2, 'text': 'red', 'color': 'blue', 'response': 'blue', 'rt': 765}:
+    - the dimensions of the key are columns; integer indices become ints
+    - nested dicts in the value are flattened, e.g., 'response.correct'
+    - name.units suffixes (rt.ms) are dropped from field names; values are
+      not converted
+    - a value that is not a dict is in the column 'value'
+    Special sections, simple keys, and bad keys give no rows. Preprocess
+    directives in =Header= are not applied.
+    """
+    return _iter_rows(source, units, None)
+
+def _iter_rows(source, units, dims_where):
+    """iter_rows(); blocks whose key has a name in dims_where {name: index}, with
+    a different index, are skipped without being parsed as YAML (for OBF_Query).
+    """
+    if isinstance(source, OBF_Load):
+        raise TypeError, "OBF: ERROR: iter_rows() needs the source, not an OBF_Load(); its keys are already expanded"
+    units = map(lambda x: x.lower(), units)
+    is_text = not isinstance(source, dict)
+    if is_text:
+        blocks = _text_blocks(source)
+    else:
+        blocks = source.iteritems()
+    
+    batch = []
+    for key, value in blocks:
+        dims = _complex_key_dims(key, units)
+        if dims is None:
+            continue
+        if dims_where:
+            skip = False
+            for name, index in dims:
+                if name in dims_where and dims_where[name] != index:
+                    skip = True
+                    break
+            if skip:
+                continue
+        if not is_text:
+            yield _make_row(dims, value, units)
+            continue
+        batch.append((dims, value))
+        if len(batch) == _ROWS_BATCH:
+            for row in _load_rows(batch, units):
+                yield row
+            batch = []
+    for row in _load_rows(batch, units):
+        yield row
+
+def _text_blocks(source):
+    """Returns [(key, text), ...] for the top-level blocks of raw OBF text.
+    
+    key is cleaned as in process_yaml(); text is the rest of the block, after
+    the colon. A repeated key keeps its first position and its last text.
+    """
+    lines = source if hasattr(source, 'next') else source.readlines()
+    blocks = []
+    position = {} # key --> index in blocks
+    key = None
+    block = []
+    for line in lines:
+        first = line[:1]
+        if first in ('', ' ', '\t', '#', '\n', '\r') or (first == '-' and not line.startswith('---')):
+            if key is not None:
+                block.append(line) # continuation of the current block
+            continue
+        if key is not None:
+            _add_block(blocks, position, key, block)
+        key = None
+        if _good_key_re.match(line) or _almost_good_key_re.match(line):
+            colon = line.find(':')
+            key = _clean_key(line[:colon])
+            block = [line[colon+1:]]
+    if key is not None:
+        _add_block(blocks, position, key, block)
+    return blocks
+
+def _add_block(blocks, position, key, block):
+    text = ''.join(block)
+    if not text.endswith('\n'):
+        text += '\n'
+    if key in position:
+        blocks[position[key]] = (key, text) # the last one wins, as in yaml
+    else:
+        position[key] = len(blocks)
+        blocks.append((key, text))
+
+def _load_rows(batch, units):
+    """Parses a batch of [(dims, text), ...] as one YAML document; returns the rows."""
+    if not batch:
+        return []
+    text = ''.join(['b%d: %s' % (i, block_text) for i, (dims, block_text) in enumerate(batch)])
+    values = yaml.load(text, Loader=_RowsLoader)
+    return [_make_row(dims, values['b%d' % i], units) for i, (dims, block_text) in enumerate(batch)]
+
+def _make_row(dims, value, units):
+    row = {}
+    if type(value) is dict:
+        _flatten_fields(value, '', row, units)
+    else:
+        row['value'] = value
+    row.update(dims) # dimensions win over a field of the same name
+    return row
+
+def _clean_key(key):
+    return re.sub(r"\s*\+\s*", '+', key.replace(',', '+').strip())
+
+def _complex_key_dims(key, units):
+    """Returns [(name, index), ...] for a complex key, else None.
+    
+    Keys are cleaned and screened as in process_yaml() and parse_keys().
+    """
+    if not isinstance(key, basestring):
+        return None
+    key = _clean_key(key)
+    if _looks_like_special_key_re.match(key) or _bad_key_re.search(key) or _valid_var_re.match(key):
+        return None
+    dims = []
+    for condition in key.split('+'):
+        if not '.' in condition:
+            return None
+        name, index = condition.split('.', 1)
+        if _numeric_re.match(index):
+            index = int(index)
+        elif _digits_as_str_re.match(index):
+            index = index.replace('_', '') # as the default convention would
+        dims.append((name, index))
+    if len(dims) == 1 and not type(dims[0][1]) is int:
+        index_lower = dims[0][1].lower()
+        if index_lower == _UNITS_LABEL or index_lower in units:
+            return None # simple.units, not a complex key
+    return dims
+
+def _flatten_fields(value, prefix, row, units):
+    for key, item in value.iteritems():
+        name = str(key)
+        match = _label_dot_units_re.match(name)
+        if match and match.group(2).lower() in units:
+            name = match.group(1)
+        if prefix:
+            name = prefix + '.' + name
+        if type(item) is dict:
+            _flatten_fields(item, name, row, units)
+        else:
+            row[name] = item
+
+
+# iter_rows() does its own key handling, so can parse blocks with libyaml if present:
+_RowsLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_ROWS_BATCH = 1000 # blocks per yaml.load()
+
+# Aggregates for OBF_Query; None values are ignored by all of them:
+_AGGREGATES = ['count', 'sum', 'mean', 'min', 'max']
+
+class OBF_Query(object):
+    """Class for filter / group-by / aggregate over the rows of OBF sources.
+    
+    Each add(source) is a single pass over iter_rows(source); only the
+    running aggregates are kept, so many files can be added in turn. Example:
+    mean rt per text x color, for correct responses only, from blocks like
+    
+        trial.1 + text.red + color.blue:
+            response:
+                key: b
+                correct: True
+            rt.ms: 765
+    
+        q = OBF_Query(where={'response.correct': True}, group_by=['text', 'color'],
+                      aggregate={'mean_rt': ('rt', 'mean'), 'n': (None, 'count')})
+        for filename in filenames:
+            q.add(open(filename))
+        q.result()  # {('red', 'blue'): {'mean_rt': 765.0, 'n': 2}, ...}, in ms
+    
+    - where: {column: value, ...} (all must be equal), or a function(row) -> bool.
+      Conditions on key dimensions are checked before the block is parsed.
+    - group_by: column names; a missing column groups as None
+    - aggregate: {output_name: (column, how)}, how in _AGGREGATES; column None
+      with 'count' counts rows
+    """
+    def __init__(self, where=None, group_by=(), aggregate=None, units=_UNITS):
+        if aggregate is None:
+            aggregate = {'count': (None, 'count')}
+        for name, (column, how) in aggregate.items():
+            if not how in _AGGREGATES:
+                raise ValueError, "OBF: ERROR: unknown aggregate '%s' for '%s'" % (how, name)
+            if column is None and how != 'count':
+                raise ValueError, "OBF: ERROR: aggregate '%s' needs a column for '%s'" % (how, name)
+        self.where = where
+        self.group_by = list(group_by)
+        self.aggregate = aggregate
+        self.units = units
+        self._groups = {} # group tuple: {output_name: [n, total, lo, hi]}
+    
+    def add(self, source):
+        """Stream the rows of one source into the running aggregates."""
+        where = self.where
+        dims_where = where if isinstance(where, dict) else None
+        group_by = self.group_by
+        aggregate = self.aggregate.items()
+        groups = self._groups
+        for row in _iter_rows(source, self.units, dims_where):
+            if dims_where:
+                match = True
+                for column, value in dims_where.iteritems():
+                    if row.get(column) != value:
+                        match = False
+                        break
+                if not match:
+                    continue
+            elif where is not None and not where(row):
+                continue
+            group = tuple([row.get(column) for column in group_by])
+            if not group in groups:
+                groups[group] = dict((name, [0, 0, None, None]) for name, spec in aggregate)
+            states = groups[group]
+            for name, (column, how) in aggregate:
+                state = states[name]
+                if column is None:
+                    state[0] += 1
+                    continue
+                value = row.get(column)
+                if value is None:
+                    continue
+                state[0] += 1
+                if how == 'sum' or how == 'mean':
+                    state[1] += value
+                elif how == 'min':
+                    if state[2] is None or value < state[2]:
+                        state[2] = value
+                elif how == 'max':
+                    if state[3] is None or value > state[3]:
+                        state[3] = value
+        return self
+    
+    def result(self):
+        """Returns {group tuple: {output_name: value}} for everything added so far."""
+        results = {}
+        for group, states in self._groups.iteritems():
+            results[group] = {}
+            for name, (column, how) in self.aggregate.items():
+                n, total, lo, hi = states[name]
+                if how == 'count':
+                    value = n
+                elif how == 'sum':
+                    value = total
+                elif how == 'mean':
+                    value = float(total) / n if n else None
+                elif how == 'min':
+                    value = lo
+                else:
+                    value = hi
+                results[group][name] = value
+        return results
+
+
 class OBF_Dump(object):
     """Class for creating an OBF file-like data source; OBF text -> internal data.
     
@@ -503,7 +1107,8 @@ def _get_default_conventions():
     def some_action(this_dict, this_key, this_obj):
     - this action was triggered by 'this_key' of 'this_dict' 
     - typically do something with the value, this_dict[key], not the key
-    - can also update this_dict or this_obj (eg, this_obj.report -> self.report)
+    - can also update this_dict or this_obj (eg, this_obj.report.add(code, key)
+      or this_obj.report.append(text) -> self.report)
     - return ('flag', a_value)
     """
     def do_digits_as_str(this_dict, this_key, this_obj):
@@ -527,10 +1132,10 @@ def _get_default_conventions():
             del this_dict[this_key]
             return {'new_key': new_key}
         else:
-            this_obj.report.append("OBF: WARN: bad units for '%s." % this_key)
+            this_obj.report.add('bad_units', this_key)
     def do_random_seed(this_dict, this_key, this_obj):
         if this_dict[this_key] == 'None':
-            this_obj.report.append("OBF: WARNING: ambiguous random_seed 'None'")
+            this_obj.report.add('random_seed_none', this_key)
     def do_mouse(this_dict, this_key, this_obj):
         mouse = this_dict[this_key]
         if type(mouse) == dict:
@@ -538,7 +1143,7 @@ def _get_default_conventions():
                 if 'pos' in mouse and type(mouse['pos'])==list and len(mouse['pos'])==2:
                     return
                 else:
-                    this_obj.report.append("OBF: ERROR: mouse lacks (x,y) or pos[]")
+                    this_obj.report.add('mouse_xy', this_key)
     key_action_dict = {
         # regex 'trigger': function_reference,
         # can safely assume no whitespace
@@ -567,6 +1172,18 @@ def clear_default_actions():
         key_action_dict[key] = _do_nothing
     return key_action_dict
 
+def format_output(data):
+    """Returns the text that 'python obf.py file.obf' prints for an OBF_Load().
+    
+    One line per top-level key of data.data, then data.report, then data.time
+    if timing was requested. Also used by obfd.py to answer clients.
+    """
+    lines = ['%s %s' % (k, data.data[k]) for k in sorted(data.data)]
+    lines.append(str(data.report))
+    if hasattr(data, 'time'):
+        lines.extend(data.time)
+    return '\n'.join(lines) + '\n'
+
 def example1():
     return '''
 =Header=:
@@ -727,6 +1344,83 @@ def test_OBF_Load():
     # test for expected parsing:
     assert 'zz10' in data.data.keys()
     assert len(data.data['list_of_lists']) == 1
+    assert data.data['multiple_mouse_clicks']['mouse']['RT.units'] == 'ms'
+    
+    # lazy conventions give the same result, once accessed:
+    lazy = OBF_Load(StringIO.StringIO(example1()), lazy=True)
+    assert 'RT.ms' in lazy.data._data['multiple_mouse_clicks']['mouse']
+    assert lazy.data['multiple_mouse_clicks']['mouse']['RT.units'] == 'ms'
+    assert lazy.data == data.data
+    lazy = OBF_Load(StringIO.StringIO(example1()), lazy=True)
+    assert dict(lazy.data) == data.data
+    # a convention that fails leaves its subtree pending, not half-processed:
+    failures = [ValueError('once')]
+    def fail_once(this_dict, this_key, this_obj):
+        if failures:
+            raise failures.pop()
+    lazy = OBF_Load(StringIO.StringIO(example1()), conventions={'stimulus': fail_once}, lazy=True)
+    try:
+        lazy.data['multiple_mouse_clicks']
+        assert False, 'expected ValueError'
+    except ValueError:
+        pass
+    assert lazy.data['multiple_mouse_clicks']['mouse']['RT.units'] == 'ms'
+    
+    # same result via chunks and a background load:
+    feed = OBF_Feed('example1')
+    text = example1()
+    for i in range(0, len(text), 100):
+        feed.feed(text[i:i+100])
+    pool = OBF_LoadPool(max_loads=2)
+    background = pool.load(feed).get()
+    # a failed load still calls back, and get() raises its error:
+    called = []
+    bad_feed = OBF_Feed('no header')
+    bad_feed.feed('=Session=:\n    a: 1\n')
+    failed = pool.load(bad_feed, callback=called.append)
+    try:
+        failed.get()
+        assert False, 'expected AttributeError'
+    except AttributeError:
+        pass
+    errors = []
+    pool.load(bad_feed, callback=called.append, error_callback=errors.append).wait()
+    pool.close()
+    assert len(called) == 1 and isinstance(called[0], AttributeError)
+    assert len(errors) == 1 and not failed.successful()
+    assert background.source == 'example1'
+    assert background.data == data.data
+    
+    # streaming query over the raw text:
+    query = OBF_Query(where={'loop': 1, 'response.correct': True}, group_by=['loop', 'tag'],
+                      aggregate={'rt': ('response.RT', 'mean'), 'n': (None, 'count')})
+    assert query.add(StringIO.StringIO(example1())).result() == {(1, 'press2'): {'rt': 0.654, 'n': 2}}
+    rows = list(iter_rows(StringIO.StringIO(example1())))
+    assert {'trial': 2, 'text': 'red', 'color': 'blue', 'response': 'blue', 'rt': 765} in rows
+    assert {'zz10': 9, 'value': 8} in rows
+
+    # a repeated key keeps only its last block, as in OBF_Load():
+    repeated = example1().replace('trial.2 + text.red + color.blue:\n    response: blue\n    rt.ms: 765',
+                                  'trial.1 + text.red + color.blue:\n    response: blue\n    rt.ms: 3')
+    assert [row['rt'] for row in iter_rows(StringIO.StringIO(repeated)) if 'text' in row] == [3]
+    assert OBF_Load(StringIO.StringIO(repeated)).data['trial'][1]['text']['red']['color']['blue']['rt'] == 3
+    
+    # structured report, deduplicated and counted as added:
+    assert data.report.count('index_zero') > 1
+    assert len([m for m in data.report if 'index 0 received' in m]) == 1
+    assert ('colon_space', 'WARNING', 'zz10.9', 136, 1) in data.report.entries()
+    assert ('random_seed_none', 'WARNING', 'random_seed', 11, 1) in data.report.entries() # =Session=
+    mouse = OBF_Load(StringIO.StringIO(example1().replace('    y: [20', '    yy: [20')))
+    assert [line for code, severity, key, line, count in mouse.report.entries() if code == 'mouse_xy'] == [102]
+    report = OBF_Report(cap=2)
+    for key in ['a', 'b', 'c', 'a']:
+        report.add('bad_key', key)
+    assert report.count('bad_key') == 4
+    assert report.messages() == ["OBF: ignoring bad key 'a'", "OBF: ignoring bad key 'b'",
+                                 "OBF: NOTE: 1 more 'bad_key' messages not recorded"]
+    report.append("OBF: ERROR: from a custom convention")
+    report.append("just a note")
+    assert [entry[1] for entry in report.entries()][-2:] == ['ERROR', 'NOTE']
     
     # test for expected error messages:
     assert "OBF: WARNING: adding space after colon for key 'zz10.9:8'" in data.report
@@ -750,10 +1444,5 @@ if __name__ == '__main__':
     #print data.data['zzz'] # test _1_ -> '1'
     #print data.time
     
-    for k in sorted(data.data):
-        print k, data.data[k]
-    print data.report
-    
-    for t in data.time:
-        print t
+    sys.stdout.write(format_output(data))
     
\ No newline at end of file
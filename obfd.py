@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+# obfd.py:  A persistent local parse server (and thin client) for obf.py
+# Copyright 2011 by Jeremy R. Gray, jrgray@gmail.com
+# Distributed under the terms of the GNU General Public License (GPL), v3.
+
+# Calling 'python obf.py file.obf' pays for interpreter startup, importing yaml,
+# and compiling obf.py's regexes, every time; for small files that is more than
+# the parse itself. 'python obfd.py serve' does all that once, and keeps a pool
+# of warm parser processes behind a Unix socket. 'python obfd.py file.obf ...'
+# is the client: it imports neither yaml nor obf (unless no server is running),
+# and prints exactly what 'python obf.py file.obf' would.
+#
+# Usage:
+#   python obfd.py serve [-s socket] [-w workers] [-q queue_depth]
+#   python obfd.py [-s socket] file.obf [file.obf ...]
+#
+# The socket defaults to $OBFD_SOCKET, else $XDG_RUNTIME_DIR/obfd.sock, else
+# /tmp/obfd-<uid>/obfd.sock. The server makes a missing directory with mode 0700;
+# the client only talks to a socket owned by the same user.
+
+
+__version__ = '0.5.00'
+
+import os
+import sys
+import socket
+import getopt
+
+
+_USAGE = '''usage:
+  python obfd.py serve [-s socket] [-w workers] [-q queue_depth]
+  python obfd.py [-s socket] file.obf [file.obf ...]
+'''
+# per-user, so that another user cannot bind the path first and answer for us:
+_TMP_DIR = '/tmp/obfd-%d' % os.getuid() # made with mode 0700 if need be
+_SOCKET = (os.environ.get('OBFD_SOCKET') or
+           os.path.join(os.environ.get('XDG_RUNTIME_DIR') or _TMP_DIR, 'obfd.sock'))
+_WORKERS = 4 # parser processes
+_QUEUE_DEPTH = 64 # requests waiting for a worker, beyond those being parsed
+
+# Protocol: the client sends one absolute path per line, then shuts down its
+# side of the connection. For each path, in order, the server replies with a
+# line 'status nbytes' followed by nbytes of payload:
+_OK = 'ok' # payload is obf.format_output()
+_ERROR = 'error' # payload is the error message
+_BUSY = 'busy' # queue_depth exceeded; payload is a message
+
+
+def _parse_path(path):
+    """Runs in a worker process: parse one file, return (status, payload).
+    """
+    import obf
+    try:
+        data = obf.OBF_Load(open(path), timing=True)
+        payload = obf.format_output(data)
+    except Exception, e:
+        return _ERROR, '%s: %s\n' % (e.__class__.__name__, e)
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return _OK, payload
+
+def _ignore_sigint():
+    # workers exit with the server; let only the server see Ctrl-C
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class OBF_Server(object):
+    """Class for serving OBF parses over a local Unix socket.
+
+    Requests are handled concurrently, one thread per connection; parsing is
+    done by a multiprocessing.Pool of `workers` processes, each of which has
+    already imported obf and yaml. At most workers + queue_depth paths are
+    queued or being parsed at once. A connection with more paths than that
+    waits for its own earlier results before submitting more; only when other
+    connections hold every slot is a path answered with 'busy' (the client then
+    parses it locally) rather than queued without bound.
+    """
+    def __init__(self, socket_path=_SOCKET, workers=_WORKERS, queue_depth=_QUEUE_DEPTH):
+        import threading
+        import collections
+        import multiprocessing
+        import SocketServer
+        import obf # import once, before forking the workers
+
+        if workers < 1 or queue_depth < 0:
+            raise ValueError, "OBFD: ERROR: need workers >= 1 and queue_depth >= 0"
+        self.socket_path = socket_path
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+
+        socket_dir = os.path.dirname(os.path.abspath(socket_path))
+        if not os.path.exists(socket_dir):
+            os.makedirs(socket_dir, 0700)
+        if socket_dir == _TMP_DIR: # might have been made by someone else first
+            _check_owner(socket_dir)
+            if os.stat(socket_dir).st_mode & 077:
+                raise IOError, "OBFD: ERROR: '%s' must have mode 0700" % socket_dir
+        if os.path.exists(socket_path):
+            _check_owner(socket_path) # never unlink another user's socket
+            if _connect(socket_path) is not None:
+                raise IOError, "OBFD: ERROR: a server is already running at '%s'" % socket_path
+            os.unlink(socket_path) # stale, from a server that did not exit cleanly
+
+        self.pool = multiprocessing.Pool(workers, _ignore_sigint)
+        server = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                paths = [line.rstrip('\n') for line in self.rfile if line.strip()]
+                # submit as many as there are slots, so that one client's paths
+                # parse in parallel; when full, answer our own oldest path first:
+                pending = collections.deque()
+                try:
+                    for path in paths:
+                        result = server.submit(path)
+                        while result is None and pending:
+                            self.reply(server.collect(pending.popleft()))
+                            result = server.submit(path)
+                        pending.append(result) # None --> busy, in its turn
+                    while pending:
+                        self.reply(server.collect(pending.popleft()))
+                except socket.error:
+                    pass # the client went away, e.g., '| head' or Ctrl-C
+                finally:
+                    # nobody will read these, but their slots must be released:
+                    while pending:
+                        server.collect(pending.popleft())
+            def finish(self):
+                try:
+                    SocketServer.StreamRequestHandler.finish(self)
+                except socket.error:
+                    pass # unsent reply bytes, for a client that went away
+            def reply(self, result):
+                status, payload = result
+                self.wfile.write('%s %d\n' % (status, len(payload)))
+                self.wfile.write(payload)
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(socket_path, Handler)
+
+    def submit(self, path):
+        """Queue one path for parsing; returns a handle for collect()."""
+        if not self._slots.acquire(False):
+            return None
+        try:
+            return self.pool.apply_async(_parse_path, (path,))
+        except:
+            self._slots.release()
+            raise
+    def collect(self, result):
+        """Wait for a submitted path; returns (status, payload)."""
+        if result is None:
+            return _BUSY, "OBFD: ERROR: server busy (queue_depth %d)\n" % self.queue_depth
+        try:
+            return result.get()
+        finally:
+            self._slots.release()
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+    def close(self):
+        self.server.server_close()
+        self.pool.terminate()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def _check_owner(path):
+    if os.stat(path).st_uid != os.getuid():
+        raise IOError, "OBFD: ERROR: '%s' is owned by another user" % path
+
+def _connect(socket_path):
+    """Returns a connected socket, or None if no server is listening.
+
+    Raises IOError if socket_path belongs to another user: whoever listens there
+    would see the paths sent and could answer anything.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    _check_owner(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def request(paths, socket_path=_SOCKET):
+    """Send paths to a running server; returns a list of (status, payload).
+
+    Returns None if no server is listening at socket_path.
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    try:
+        sock.sendall(''.join(os.path.abspath(p) + '\n' for p in paths))
+        sock.shutdown(socket.SHUT_WR)
+        reply = sock.makefile('rb')
+        results = []
+        for path in paths:
+            status, nbytes = reply.readline().split()
+            results.append((status, reply.read(int(nbytes))))
+        return results
+    finally:
+        sock.close()
+
+def main(argv):
+    opts, args = getopt.gnu_getopt(argv, 's:w:q:')
+    opts = dict(opts)
+    socket_path = opts.get('-s', _SOCKET)
+
+    if args and args[0] == 'serve':
+        server = OBF_Server(socket_path,
+                            workers=int(opts.get('-w', _WORKERS)),
+                            queue_depth=int(opts.get('-q', _QUEUE_DEPTH)))
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # clean up on kill
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if not args:
+        sys.stderr.write(_USAGE)
+        return 2
+
+    try:
+        results = request(args, socket_path)
+    except IOError, e: # not our socket
+        sys.stderr.write('%s\n' % e)
+        results = None
+    if results is None: # no server; do what 'python obf.py' would
+        sys.stderr.write("OBFD: no server at '%s', parsing locally\n" % socket_path)
+        results = [_parse_path(path) for path in args]
+    exit_status = 0
+    for path, (status, payload) in zip(args, results):
+        if status == _BUSY: # server overloaded by other clients
+            status, payload = _parse_path(path)
+        if status == _OK:
+            sys.stdout.write(payload)
+        else:
+            sys.stderr.write(payload)
+            exit_status = 1
+    return exit_status
+
+
+def test_obfd():
+    """Run tests.
+    """
+    import tempfile
+    import threading
+    import obf
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'private', 'obfd.sock')
+    assert request(['example.obf'], socket_path) is None
+
+    server = OBF_Server(socket_path, workers=2, queue_depth=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        assert os.stat(os.path.dirname(socket_path)).st_mode & 0777 == 0700
+        results = request(['example.obf', 'no_such_file.obf'], socket_path)
+        status, payload = results[0]
+        assert status == _OK
+        expected = obf.format_output(obf.OBF_Load(open(os.path.abspath('example.obf'))))
+        assert payload.startswith(expected[:expected.index('\n[')]) # data lines match
+        assert results[1][0] == _ERROR
+
+        # more paths than workers + queue_depth in one request still all parse:
+        results = request(['example.obf'] * 5, socket_path)
+        assert [status for status, payload in results] == [_OK] * 5
+
+        # a client that leaves without reading its replies does not keep slots:
+        import time
+        sock = _connect(socket_path)
+        sock.sendall((os.path.abspath('example.obf') + '\n') * 6)
+        sock.shutdown(socket.SHUT_WR)
+        sock.close()
+        time.sleep(0.5) # let the server start on it
+        for i in range(100):
+            if server._slots._Semaphore__value == 2:
+                break
+            time.sleep(0.1)
+        results = request(['example.obf'] * 3, socket_path)
+        assert [status for status, payload in results] == [_OK] * 3
+        assert server._slots._Semaphore__value == 2
+
+        # queue_depth=0 and 2 workers: a third concurrent path is refused
+        held = [server.submit('example.obf') for i in range(2)]
+        assert server.collect(server.submit('example.obf'))[0] == _BUSY
+        for result in held:
+            server.collect(result)
+    finally:
+        server.server.shutdown()
+        thread.join() # serve_forever() closes the pool on the way out
+
+    print 'all tests pass'
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))